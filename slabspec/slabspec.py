@@ -1,14 +1,14 @@
 import os
 import urllib
 import pickle as pickle
+from functools import lru_cache
 import numpy as np
 import matplotlib.pylab as plt
-from scipy.interpolate import interp1d
+from scipy.fft import next_fast_len
 from astropy.io import fits
 from astropy.constants import c,h, k_B, G, M_sun, au, pc, u
 from astropy.table import Table
 from astropy import units as un
-from astropy.convolution import Gaussian1DKernel, convolve_fft
 import pandas as pd
 
 from slabspec.helpers import fwhm_to_sigma, sigma_to_fwhm, markgauss, compute_thermal_velocity, get_molecule_identifier, extract_hitran_data,get_global_identifier
@@ -77,21 +77,34 @@ def spec_convol(wave,flux,dv):
 
     # convolve the flux with a gaussian kernel; first convert the FWHM to sigma
     sigma_s = fwhm_s / 2.3548
-    try:
-        # for astropy < 0.4
-        g = Gaussian1DKernel(width=sigma_s)
-    except TypeError:
-        # for astropy >= 0.4
-        g = Gaussian1DKernel(sigma_s)
-    # use boundary='extend' to set values outside the array to nearest array value.
-    # this is the best approximation in this case.
-    flux_conv = convolve_fft(flux_constfwhm, g, normalize_kernel=True, boundary='fill')
+    # pad with the nearest array value (as boundary='extend' would) so the edges are not pulled toward zero.
+    # this is the best approximation in this case.  The padding also keeps the FFT's wrap-around
+    # well outside the Gaussian wings.
+    npad = int(np.ceil(6*sigma_s))
+    flux_padded = np.pad(flux_constfwhm, npad, mode='edge')
+    # convolve flux and mask together so that NaN'd regions are interpolated over
+    finite = np.isfinite(flux_padded)
+    signals = np.stack([np.where(finite, flux_padded, 0.), finite.astype(float)])
+    # the Fourier transform of a unit-area Gaussian is analytic, so multiply by it directly
+    # instead of building and transforming a kernel.  The transform alone, cut off at Nyquist,
+    # rings with negative lobes (~0.1% at sigma_s=0.85), so add its aliases at k+-1, k+-2 and
+    # renormalize: this is the transform of the sampled Gaussian, which is non-negative.
+    nfft = next_fast_len(flux_padded.size, real=True)
+    k = np.fft.rfftfreq(nfft)
+    gft = np.sum([np.exp(-2.*np.pi**2*sigma_s**2*(k-m)**2) for m in range(-2,3)], axis=0)
+    ft = np.fft.rfft(signals, nfft)*(gft/gft[0])
+    num, den = np.fft.irfft(ft, nfft)[:, :flux_padded.size]
+    # inside NaN'd regions wider than the kernel, den is only FFT round-off, so leave those NaN
+    flux_conv = np.full(flux_padded.size, np.nan)
+    covered = den > 1e-6
+    flux_conv[covered] = num[covered]/den[covered]
+    flux_conv = flux_conv[npad:npad+flux_constfwhm.size]
     flux_oldsampling = np.interp(wave, wave_constfwhm, flux_conv)
 
     return flux_oldsampling
 
 
-def spec_convol_colette(wave, flux, dv):
+def spec_convol_colette(wave, flux, dv, use_gpu=False):
     '''
     Convolve a spectrum, given wavelength in microns and flux density, by a given FWHM in velocity
 
@@ -103,6 +116,8 @@ def spec_convol_colette(wave, flux, dv):
         flux density values, in units of Energy/area/time/Hz
     dv : float
         FWHM of convolution kernel, in km/s
+    use_gpu : bool, optional
+        Perform the convolution on the GPU.  Requires cupy.  Defaults to False.
 
     Returns
     --------
@@ -113,9 +128,9 @@ def spec_convol_colette(wave, flux, dv):
 
     #Program assumes units of dv are km/s, and dv=FWHM
     dv = fwhm_to_sigma(dv)
-    n = round(4.*dv/(c.value*1e-3)*np.median(wave)/(wave[1]-wave[0]))
+    n = int(round(4.*dv/(c.value*1e-3)*np.median(wave)/(wave[1]-wave[0])))
     if (n < 10):
-        n = 10.
+        n = 10
 
     #Pad arrays to deal with edges
     dwave = wave[1]-wave[0]
@@ -132,24 +147,30 @@ def spec_convol_colette(wave, flux, dv):
     flux = np.concatenate([flux_low, flux, flux_high])
     mask = np.concatenate([mask_low, mask_middle, mask_high])
 
-    newflux = np.copy(flux)
-
-    if( n > (np.size(wave)-n)):
-        print("Your wavelength range is too small for your kernel")
-        print("Program will return an empty array")
-
-    for i in np.arange(n, np.size(wave)-n+1):
-        lwave = wave[np.int(i-n):np.int(i+n+1)]
-        lflux = flux[np.int(i-n):np.int(i+n+1)]
-        lvel = (lwave-wave[np.int(i)])/wave[np.int(i)]*c.value*1e-3
-        nvel = (np.max(lvel)-np.min(lvel))/(dv*.2) +3
-        vel = np.arange(nvel)
-        vel = .2*dv*(vel-np.median(vel))
-        kernel = markgauss(vel,mean=0,sigma=dv,area=1.)
-        wkernel = np.interp(lvel,vel,kernel)   #numpy interp is almost factor of 2 faster than interp1d
-        wkernel = wkernel/np.nansum(wkernel)
-        newflux[np.int(i)] = np.nansum(lflux*wkernel)/np.nansum(wkernel[np.isfinite(lflux)])
-        #Note: denominator is necessary to correctly account for NaN'd regions
+    #The kernel at each pixel is a Gaussian in velocity, (wave-wave[i])/wave[i]*c, so its width in pixels
+    #changes with wavelength.  Rather than looping over pixels, loop over the 2n+1 pixel offsets and
+    #add each offset's contribution to every pixel at once.
+    finite = np.isfinite(flux)
+    fclean = np.where(finite, flux, 0.)
+    if(use_gpu):
+        #cupy is only needed for the GPU path, so only import it here
+        import cupy as xp
+    else:
+        xp = np
+    nwave = np.size(wave)
+    xwave = xp.asarray(wave)
+    fpad = xp.pad(xp.asarray(fclean), n)
+    mpad = xp.pad(xp.asarray(finite.astype(float)), n)
+    num = xp.zeros(nwave)
+    den = xp.zeros(nwave)
+    for j in range(-n, n+1):
+        weight = markgauss(j*dwave/xwave*c.value*1e-3,mean=0,sigma=dv,area=1.)
+        num += weight*fpad[n+j:n+j+nwave]
+        den += weight*mpad[n+j:n+j+nwave]
+    newflux = num/den
+    if(use_gpu):
+        newflux = xp.asnumpy(newflux)
+    #Note: denominator is necessary to correctly account for NaN'd regions
 
     #Remove NaN'd regions
     nanbool = np.invert(np.isfinite(flux))   #Places where flux is not finite
@@ -161,6 +182,42 @@ def spec_convol_colette(wave, flux, dv):
     return newflux
 
 #------------------------------------------------------------------------------------
+@lru_cache(maxsize=2)
+def _get_grid(wmin, wmax, nbins):
+    '''
+    Build the log-spaced wavelength grid used by make_spec.
+    Results are cached, since the grid does not depend on the slab parameters.
+    Note that nbins depends on deltav, which defaults to the thermal velocity, so the cache
+    only helps sweeps at fixed deltav.  Grids can be tens of MB, so only a couple are kept.
+
+    Parameters
+    ---------
+    wmin : float
+        Minimum wavelength, in microns
+    wmax : float
+        Maximum wavelength, in microns
+    nbins : int
+        Number of grid points
+
+    Returns
+    --------
+    totalwave : numpy array
+        Wavelength grid, in microns (read-only)
+    wn : numpy array
+        Wavenumber grid, in m^-1 (read-only)
+    inv_dlog : float
+        Inverse of the grid spacing in log10(wavelength)
+    '''
+    totalwave = np.logspace(np.log10(wmin),np.log10(wmax),nbins)
+    wn = 1.e6/totalwave #m^{-1}
+    inv_dlog = (nbins-1)/np.log10(wmax/wmin)
+
+    #Cached arrays are shared between calls, so guard them against modification
+    totalwave.flags.writeable = False
+    wn.flags.writeable = False
+
+    return totalwave, wn, inv_dlog
+
 def make_spec(molecule_name, n_col, temp, area, wmax=40, wmin=1, deltav=None, isotopologue_number=1, d_pc=1,
               aupmin=None, convol_fwhm=None, eupmax=None, vup=None, swmin=None):
 
@@ -262,46 +319,69 @@ def make_spec(molecule_name, n_col, temp, area, wmax=40, wmin=1, deltav=None, is
     omega = area/(d_pc*pc.value)**2.
     fthin = aup*gup*n_col*h.value*c.value*wn0/(q*4.*np.pi)*np.exp(-efactor)*omega # Energy/area/time, mks
 
-    #Loop over transitions and velocities to calculate flux
+    #Compute tau and wavelength for each transition and velocity
+    #All lines share the same Gaussian profile, so compute it once and broadcast (nlines x nvel)
     nlines = np.size(tau0)
-    tau = np.zeros([nlines,nvel])
-    wave = np.zeros([nlines,nvel])
-    for ha,mytau in enumerate(tau0):
-        tau[ha,:] = tau0[ha]*np.exp(-vel**2./(2.*deltav**2.))
-        wave[ha,:] = 1.e6/wn0[ha]*(1+vel/c.value)
+    #tau is only accumulated into the float64 totaltau, so single precision is enough and halves its memory traffic
+    profile = np.exp(-vel**2./(2.*deltav**2.))
+    tau = np.multiply(np.asarray(tau0)[:,None], profile[None,:], dtype=np.float32)
+    wave = (1.e6/np.asarray(wn0))[:,None]*(1+vel/c.value)[None,:]
 
     #Interpolate over wavelength space so that all lines can be added together
     w_arr = wave            #nlines x nvel
-    f_arr = w_arr-w_arr     #nlines x nvel
+    f_arr = np.zeros_like(w_arr)     #nlines x nvel
     nbins = int(oversamp*wmax/(wmax-wmin)*(c.value/deltav))
 
     #Create arrays to hold full spectrum (optical depth vs. wavelength)
-    totalwave = np.logspace(np.log10(wmin),np.log10(wmax),nbins)
+    totalwave, wn, inv_dlog = _get_grid(wmin, wmax, nbins)
     totaltau = np.zeros(nbins)
 
     #Create array to hold line fluxes (one flux value per line)
     lineflux = np.zeros(nlines)
-    totalwave_index = np.arange(totalwave.size)
-    index_interp = interp1d(totalwave,totalwave_index)
-    for i in range(nlines):
-
-        minw = np.min(wave[i,:])
-        maxw = np.max(wave[i,:])
-        minindex = int(index_interp(minw))
-        maxindex = int(index_interp(maxw))
-
-        w = np.arange(minindex,maxindex)
 
-        if(w.size > 0):
-            newtau = np.interp(totalwave[w],wave[i,:], tau[i,:])
-            totaltau[w] += newtau
-            f_arr[i,:] = 2*h.value*c.value*wn0[i]**3./(np.exp(wnfactor[i])-1.0e0)*(1-np.exp(-tau[i,:]))*omega
-            lineflux[i] = np.sum(f_arr[i,:]) * (dvel/c.value) * (c.value*wn0[i]) #in W/m2
+    #Range of grid indices covered by each line, from the inverse of the log-spaced grid
+    minindex = (np.log10(np.min(wave,axis=1))-np.log10(wmin))*inv_dlog
+    maxindex = (np.log10(np.max(wave,axis=1))-np.log10(wmin))*inv_dlog
+    minindex = np.clip(np.floor(minindex),0,nbins).astype(int)
+    maxindex = np.clip(np.floor(maxindex),0,nbins).astype(int)
+    haslines = maxindex > minindex
+
+    #Lines with negligible peak tau do not change totaltau, so leave them out of the accumulation.
+    #A line is skipped only if its tau0 is below both 1e-6 (negligible next to an optically thick
+    #spectrum) and 1e-8 of the strongest line (negligible next to an optically thin one), so optically
+    #thin slabs keep every line.  They are still included in the line fluxes below.
+    taumin = min(1e-6, 1e-8*np.max(tau0, initial=0))
+    addlines = haslines & (np.asarray(tau0) > taumin)
+    addwave = wave[addlines,:]
+    addtau = tau[addlines,:]
+
+    #Interpolate every line onto its grid points at once (naddlines x nw), then add them all to totaltau
+    nw = np.max(maxindex[addlines]-minindex[addlines], initial=0)
+    w = minindex[addlines,None]+np.arange(nw)
+    inrange = w < maxindex[addlines,None]
+    w[~inrange] = 0
+    pos = (totalwave[w]-addwave[:,[0]])/(addwave[:,[1]]-addwave[:,[0]])   #wave is linear in vel, so this is the fractional index
+    pos = np.clip(pos,0,nvel-1)
+    lo = np.minimum(pos.astype(int),nvel-2)
+    frac = pos-lo
+    newtau = np.take_along_axis(addtau,lo,axis=1)*(1-frac)+np.take_along_axis(addtau,lo+1,axis=1)*frac
+    totaltau += np.bincount(w[inrange],weights=newtau[inrange],minlength=nbins)
+
+    wn0_arr = np.asarray(wn0)
+    #Planck function at each line center, computed once for all lines
+    planck_line = 2*h.value*c.value*wn0_arr**3./np.expm1(np.asarray(wnfactor))
+    #Line fluxes use double precision tau, since tau0 of weak lines can be below the float32 range
+    f_arr[haslines,:] = planck_line[haslines,None]*(-np.expm1(-np.asarray(tau0)[haslines,None]*profile[None,:]))*omega
+    lineflux[haslines] = np.sum(f_arr[haslines,:],axis=1) * (dvel/c.value) * (c.value*wn0_arr[haslines]) #in W/m2
 
     wave_arr = wave
-    wn = 1.e6/totalwave #m^{-1}
     wnfactor = h.value*c.value*wn/(k_B.value*temp)
-    flux = 2*h.value*c.value*wn**3./(np.exp(wnfactor)-1.0e0)*(1-np.exp(-totaltau))*si2jy*omega #in Jy
+    #Fold the scalar factors together and work in place to limit nbins-sized temporaries;
+    #expm1 keeps (1-exp(-tau)) accurate at small tau
+    flux = -np.expm1(-totaltau)
+    flux *= wn**3.
+    flux /= np.expm1(wnfactor)
+    flux *= 2*h.value*c.value*si2jy*omega #in Jy
 
     wave = totalwave
 
@@ -354,11 +434,21 @@ def write_slab(slabdict,filename='slabmodel.fits'):
 
     moldata = slabdict['moldata']
     mol_cols = []
-    for key in moldata.keys():
-        try:
-            mol_cols.append(fits.Column(name=key,array=moldata[key],format='F'))
-        except:
-            mol_cols.append(fits.Column(name=key,array=moldata[key],format='A'))
+    for key in moldata.colnames:
+        array = moldata[key]
+        #Numeric and boolean columns are written as floats
+        if(array.dtype.kind in 'biuf'):
+            fmt = 'F'
+        else:
+            #Numeric-looking strings (e.g., HITRAN quanta like '  1') are also written as floats,
+            #anything else as strings wide enough to hold the longest entry
+            try:
+                array = np.asarray(array).astype(float)
+                fmt = 'F'
+            except ValueError:
+                width = max(array.dtype.itemsize//(4 if array.dtype.kind == 'U' else 1), 1)
+                fmt = str(width)+'A'
+        mol_cols.append(fits.Column(name=key,array=array,format=fmt))
     t2 = fits.BinTableHDU.from_columns(mol_cols)
 
     primary = fits.PrimaryHDU()
@@ -388,6 +478,27 @@ def compute_partition_function(molecule_name,temp,isotopologue_number=1):
     '''
 
     G = get_global_identifier(molecule_name, isotopologue_number=isotopologue_number)
+    qtemp, qvalues = _get_partition_data(G)
+
+    q = np.interp(temp,qtemp,qvalues)
+    return q
+
+@lru_cache(maxsize=None)
+def _get_partition_data(G):
+    '''
+    Download the HITRAN partition function table for a given global identifier.
+    Results are cached, so each table is only downloaded once per session.
+
+    Parameters
+    ----------
+    G : int
+        The HITRAN global identifier number
+
+    Returns
+    -------
+    qtemp, qvalues : numpy arrays
+        Temperatures and partition function values from the HITRAN table (read-only)
+    '''
     qurl = 'https://hitran.org/data/Q/'+'q'+str(G)+'.txt'
     handle = urllib.request.urlopen(qurl)
     qdata = pd.read_csv(handle,sep=' ',skipinitialspace=True,names=['temp','q'],header=None)
@@ -397,8 +508,14 @@ def compute_partition_function(molecule_name,temp,isotopologue_number=1):
 #    if not os.path.exists(qfilename):  #download data from internet
        #get https://hitran.org/data/Q/qstr(G).txt
 
-    q = np.interp(temp,qdata['temp'],qdata['q'])
-    return q
+    qtemp = qdata['temp'].to_numpy()
+    qvalues = qdata['q'].to_numpy()
+
+    #Cached arrays are shared between calls, so guard them against modification
+    qtemp.flags.writeable = False
+    qvalues.flags.writeable = False
+
+    return qtemp, qvalues
 
 
 #Make this its own function
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+from scipy.interpolate import interp1d
+from astropy.constants import c, h, k_B, pc
+from astropy.table import Table
+
+import slabspec.slabspec as slabspec
+from slabspec.helpers import markgauss, fwhm_to_sigma
+
+WMIN = 4.5
+WMAX = 5.
+DELTAV = 1.e4   #m/s, large enough to keep the grid small
+Q = 100.
+
+def mock_hitran_data(nlines=300, seed=0):
+    '''
+    Random line list with the HITRAN columns used by make_spec
+    '''
+    rng = np.random.default_rng(seed)
+    wn = 1.e4/rng.uniform(WMIN+0.02, WMAX-0.02, nlines)   #cm^-1
+    elower = rng.uniform(0., 5000., nlines)                #cm^-1
+    tbl = Table()
+    tbl['wn'] = wn
+    tbl['a'] = 10**rng.uniform(-3., 2., nlines)
+    tbl['gp'] = rng.integers(1, 40, nlines).astype(float)
+    tbl['elower'] = elower
+    tbl['eup_k'] = (wn+elower)*1.e2*h.value*c.value/k_B.value
+    return tbl
+
+@pytest.fixture
+def mock_hitran(monkeypatch):
+    monkeypatch.setattr(slabspec, 'extract_hitran_data', lambda *args, **kwargs: mock_hitran_data())
+    monkeypatch.setattr(slabspec, 'compute_partition_function', lambda *args, **kwargs: Q)
+
+def baseline_make_spec(hitran_data, n_col, temp, area, wmin, wmax, deltav, d_pc=1.):
+    '''
+    Line-by-line loop from the original make_spec, used as the reference.
+    (1-exp(-tau)) is computed with expm1, since the original loses all precision for optically thin lines.
+    '''
+    oversamp = 3
+    wn0 = np.asarray(hitran_data['wn'])*1e2
+    aup = np.asarray(hitran_data['a'])
+    gup = np.asarray(hitran_data['gp'])
+    afactor = ((aup*gup*n_col)/(Q*8.*np.pi*(wn0)**3.))
+    wnfactor = h.value*c.value*wn0/(k_B.value*temp)
+    phia = 1./(deltav*np.sqrt(2.0*np.pi))
+    efactor2 = np.asarray(hitran_data['eup_k'])/temp
+    efactor1 = np.asarray(hitran_data['elower'])*1.e2*h.value*c.value/k_B.value/temp
+    tau0 = afactor*(np.exp(-1.*efactor1)-np.exp(-1.*efactor2))*phia
+
+    dvel = deltav/oversamp
+    nvel = 10*oversamp+1
+    vel = (dvel*(np.arange(0,nvel)-(nvel-1)/2))
+    omega = area/(d_pc*pc.value)**2.
+
+    nlines = np.size(tau0)
+    tau = np.zeros([nlines,nvel])
+    wave = np.zeros([nlines,nvel])
+    for ha in range(nlines):
+        tau[ha,:] = tau0[ha]*np.exp(-vel**2./(2.*deltav**2.))
+        wave[ha,:] = 1.e6/wn0[ha]*(1+vel/c.value)
+    nbins = int(oversamp*wmax/(wmax-wmin)*(c.value/deltav))
+    totalwave = np.logspace(np.log10(wmin),np.log10(wmax),nbins)
+    totaltau = np.zeros(nbins)
+    lineflux = np.zeros(nlines)
+    index_interp = interp1d(totalwave,np.arange(totalwave.size))
+    for i in range(nlines):
+        w = np.arange(int(index_interp(np.min(wave[i,:]))),int(index_interp(np.max(wave[i,:]))))
+        if(w.size > 0):
+            totaltau[w] += np.interp(totalwave[w],wave[i,:], tau[i,:])
+            f_arr = 2*h.value*c.value*wn0[i]**3./(np.exp(wnfactor[i])-1.0e0)*(-np.expm1(-tau[i,:]))*omega
+            lineflux[i] = np.sum(f_arr) * (dvel/c.value) * (c.value*wn0[i])
+    wn = 1.e6/totalwave
+    wnfactor = h.value*c.value*wn/(k_B.value*temp)
+    flux = 2*h.value*c.value*wn**3./(np.exp(wnfactor)-1.0e0)*(-np.expm1(-totaltau))*1e26*omega
+    return {'totaltau':totaltau, 'flux':flux, 'lineflux':lineflux, 'tau0':tau0}
+
+@pytest.mark.parametrize('n_col', [1.e10, 1.e14, 1.e24])
+def test_make_spec_matches_baseline(mock_hitran, n_col):
+    temp = 800.
+    area = (1.5e11)**2.
+    out = slabspec.make_spec('CO', n_col, temp, area, wmin=WMIN, wmax=WMAX, deltav=DELTAV)
+    ref = baseline_make_spec(mock_hitran_data(), n_col, temp, area, WMIN, WMAX, DELTAV)
+
+    spectrum = out['spectrum']
+    assert np.max(np.abs(spectrum['flux']-ref['flux'])) <= 1e-5*np.max(ref['flux'])
+    assert np.max(np.abs(spectrum['totaltau']-ref['totaltau'])) <= 1e-5*np.max(ref['totaltau'])
+    np.testing.assert_allclose(out['lineparams']['lineflux'], ref['lineflux'], rtol=1e-10)
+    np.testing.assert_allclose(out['lineparams']['tau_peak'], ref['tau0'], rtol=1e-10)
+
+def baseline_spec_convol_colette(wave, flux, dv):
+    '''
+    Per-pixel loop from the original spec_convol_colette, used as the reference
+    '''
+    dv = fwhm_to_sigma(dv)
+    n = int(round(4.*dv/(c.value*1e-3)*np.median(wave)/(wave[1]-wave[0])))
+    n = max(n, 10)
+    dwave = wave[1]-wave[0]
+    wave_low = np.arange(wave[0]-dwave*n, wave[0]-dwave, dwave)
+    wave_high = np.arange(np.max(wave)+dwave, np.max(wave)+dwave*(n-1.), dwave)
+    mask = np.concatenate([np.zeros(wave_low.size), np.ones(wave.size), np.zeros(wave_high.size)])
+    wave = np.concatenate([wave_low, wave, wave_high])
+    flux = np.concatenate([np.zeros(wave_low.size), flux, np.zeros(wave_high.size)])
+    newflux = np.copy(flux)
+    for i in range(n, np.size(wave)-n+1):
+        lwave = wave[i-n:i+n+1]
+        lflux = flux[i-n:i+n+1]
+        lvel = (lwave-wave[i])/wave[i]*c.value*1e-3
+        nvel = (np.max(lvel)-np.min(lvel))/(dv*.2) +3
+        vel = np.arange(nvel)
+        vel = .2*dv*(vel-np.median(vel))
+        wkernel = np.interp(lvel,vel,markgauss(vel,mean=0,sigma=dv,area=1.))
+        wkernel = wkernel/np.nansum(wkernel)
+        newflux[i] = np.nansum(lflux*wkernel)/np.nansum(wkernel[np.isfinite(lflux)])
+    newflux[~np.isfinite(flux)] = np.nan
+    return newflux[mask==1]
+
+def test_spec_convol_colette_matches_baseline():
+    rng = np.random.default_rng(1)
+    wave = np.linspace(5., 15., 20000)
+    flux = np.ones(wave.size)
+    for w0 in rng.uniform(5., 15., 60):
+        flux += rng.uniform(0., 5.)*np.exp(-0.5*((wave-w0)/(w0*1e-4))**2)
+    flux[10000:10010] = np.nan
+
+    newflux = slabspec.spec_convol_colette(wave, flux, 12.5)
+    ref = baseline_spec_convol_colette(wave, flux, 12.5)
+
+    np.testing.assert_array_equal(np.isnan(newflux), np.isnan(ref))
+    #Baseline interpolates its kernel off a 0.2-sigma grid; skip the unprocessed edge pixels
+    assert np.nanmax(np.abs(newflux-ref)[20:-20]) <= 1e-3*np.nanmax(ref)
+
+def baseline_spec_convol(wave, flux, dv):
+    '''
+    Original spec_convol, using astropy's convolve_fft, used as the reference
+    '''
+    from astropy.convolution import Gaussian1DKernel, convolve_fft
+    R = c.value/(dv*1e3)
+    dw_min = np.min(np.abs(wave - np.roll(wave, 1)))
+    fwhm = wave / R
+    fwhm_s = np.max([2., np.min(fwhm / dw_min)])
+    wave_constfwhm = np.cumsum(fwhm / fwhm_s)+np.min(wave)
+    flux_constfwhm = np.interp(wave_constfwhm,wave,flux)
+    flux_conv = convolve_fft(flux_constfwhm, Gaussian1DKernel(fwhm_s / 2.3548), normalize_kernel=True, boundary='fill')
+    return np.interp(wave, wave_constfwhm, flux_conv)
+
+def test_spec_convol_nan_gap():
+    wave = np.geomspace(5., 15., 20000)
+    flux = 1.+0.1*np.sin(wave*300.)
+    flux[10000:10050] = np.nan
+
+    with np.errstate(all='raise'):
+        newflux = slabspec.spec_convol(wave, flux, 40.)
+    ref = baseline_spec_convol(wave, flux, 40.)
+
+    #Gap wider than the kernel is left NaN rather than filled with round-off
+    assert np.all(np.isnan(newflux[10005:10045]))
+    #Away from the array ends (now edge-padded) and the gap, the output matches the baseline
+    away = np.ones(wave.size, dtype=bool)
+    away[:200] = False
+    away[-200:] = False
+    away[9900:10150] = False
+    assert np.max(np.abs(newflux-ref)[away]) <= 1e-6